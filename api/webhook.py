@@ -1,19 +1,39 @@
 # api/webhook.py
 import os
-import json
+import atexit
 import logging
-import asyncio # Necesario para ejecutar funciones async con asyncio.run()
+import queue
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 # Configuración de log (para que puedas ver mensajes en los logs de Vercel)
-logging.basicConfig(level=logging.INFO)
+# Los handlers solo encolan los registros; un hilo en segundo plano los escribe en stderr,
+# así las corrutinas no se bloquean esperando la salida estándar.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
 
 # Importar librerías necesarias
 import google.generativeai as genai
+import msgpack
+import orjson
+import zstandard
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from dotenv import load_dotenv # Para desarrollo local. En Vercel, las variables son inyectadas.
 
 # Importar las librerías de Telegram
 from telegram import Update
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # --- Cargar Variables de Entorno ---
@@ -21,6 +41,7 @@ from telegram.ext import Application, CommandHandler, MessageHandler, filters, C
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL")
 
 # Verificar si las claves están presentes
 if not GOOGLE_API_KEY:
@@ -29,72 +50,454 @@ if not GOOGLE_API_KEY:
 if not TELEGRAM_BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN no encontrada. Asegúrate de configurarla en Vercel o en tu .env local.")
     # En un entorno de producción real, podrías querer levantar una excepción aquí.
+if not REDIS_URL:
+    logger.warning("REDIS_URL no encontrada. El historial de conversación solo se guardará en memoria.")
 
 # --- Configuración de la API de Gemini ---
+# genai guarda en caché sus clientes (gRPC síncrono y grpc_asyncio), así que el canal
+# se abre una vez y se reutiliza en todas las peticiones del contenedor.
 genai.configure(api_key=GOOGLE_API_KEY)
 llm_model = genai.GenerativeModel('gemini-1.5-flash')
 
-# Diccionario para almacenar el historial de conversación por chat_id de Telegram
-# ADVERTENCIA: En un entorno serverless como Vercel, este diccionario se reinicia
-# con cada nueva solicitud (cada mensaje de Telegram). Esto significa que
-# el bot no "recordará" el historial de conversación entre mensajes/turnos.
-# Para mantener el historial, necesitarías una base de datos externa (ej. Redis, Supabase, Firestore).
-# Para este Nivel 1 de despliegue, está bien, pero es una limitación a considerar.
-user_chats = {}
+# --- Almacenamiento del historial de conversación ---
+# En un entorno serverless como Vercel la memoria del proceso se pierde en cada
+# arranque en frío, así que el estado de cada usuario se guarda en Redis
+# (clave `chat:{user_id}`, con caducidad). Si REDIS_URL no está configurada,
+# se usa el diccionario `user_chats` como respaldo en memoria, limitado a
+# MAX_USERS entradas (se descartan los usuarios usados hace más tiempo).
+#
+# Para no reenviar a Gemini la conversación completa en cada turno, el estado
+# solo guarda un resumen de los turnos antiguos y los últimos mensajes (`tail`).
+# Cada SUMMARY_EVERY_TURNS turnos, los mensajes que exceden HISTORY_TAIL se
+# condensan en el resumen, así que el tamaño de cada petición queda acotado.
+#
+# En Redis el estado se guarda serializado con MessagePack y comprimido con zstd.
+CHAT_TTL_SECONDS = 3600
+# Tiempos máximos (en segundos) de conexión y de cada operación con Redis: si Redis no
+# responde, el bot sigue sin historial en lugar de agotar el tiempo de la función.
+REDIS_CONNECT_TIMEOUT = 2
+REDIS_TIMEOUT = 2
+HISTORY_TAIL = 4
+SUMMARY_EVERY_TURNS = 5
+SUMMARY_PROMPT = (
+    "Resume en pocas frases la siguiente conversación entre un usuario y un asistente, "
+    "conservando los datos importantes que el asistente deba recordar.\n\n"
+    "Resumen previo: {summary}\n\n"
+    "Conversación:\n{transcript}"
+)
+# El cliente se crea en `_get_app`, ligado al bucle de eventos que atiende las peticiones.
+redis_client: Redis | None = None
+_compressor = zstandard.ZstdCompressor(level=3)
+_decompressor = zstandard.ZstdDecompressor()
+user_chats = OrderedDict()
+MAX_USERS = 10_000
+
+# Un lock por usuario serializa sus mensajes: dos mensajes casi simultáneos del mismo usuario
+# no pueden leer el mismo estado y sobrescribirse al guardar. Usuarios distintos no se bloquean.
+# Cada entrada cuenta las corrutinas que tienen o esperan el lock y se borra al llegar a cero,
+# así nunca se descarta un lock que alguien sigue esperando.
+_user_locks = {}
+
+@asynccontextmanager
+async def _user_lock(user_id: int):
+    entry = _user_locks.get(user_id)
+    if entry is None:
+        entry = _user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and _user_locks.get(user_id) is entry:
+            del _user_locks[user_id]
+
+def _empty_state() -> dict:
+    return {"summary": "", "tail": []}
+
+def _get_chat(user_id: int) -> dict:
+    """
+    Devuelve el estado en memoria del usuario, creándolo si no existe (caché LRU de MAX_USERS entradas).
+    """
+    state = user_chats.get(user_id)
+    if state is None:
+        state = user_chats[user_id] = _empty_state()
+        if len(user_chats) > MAX_USERS:
+            user_chats.popitem(last=False)
+    else:
+        user_chats.move_to_end(user_id)
+    return state
+
+async def _load_state(user_id: int) -> dict:
+    """
+    Recupera el estado de la conversación del usuario: resumen y últimos mensajes (`Content`).
+    """
+    if redis_client is None:
+        return _get_chat(user_id)
+
+    try:
+        raw = await redis_client.get(f"chat:{user_id}")
+    except RedisError as e:
+        # Si Redis falla, se responde igualmente pero sin historial.
+        logger.warning("No se pudo leer el estado de %s desde Redis: %s", user_id, e)
+        return _empty_state()
+    if not raw:
+        return _empty_state()
+    try:
+        data = msgpack.unpackb(_decompressor.decompress(raw), raw=False)
+        return {"summary": data["summary"], "tail": [genai.protos.Content(c) for c in data["tail"]]}
+    except (zstandard.ZstdError, ValueError, KeyError, TypeError) as e:
+        # Estado ilegible (p. ej. guardado con un formato anterior): se empieza de cero.
+        logger.warning("Estado de conversación inválido para %s: %s", user_id, e)
+        return _empty_state()
+
+async def _save_state(user_id: int, state: dict) -> None:
+    """
+    Guarda el estado de la conversación del usuario.
+    """
+    if redis_client is None:
+        _get_chat(user_id).update(state)
+        return
+
+    data = {"summary": state["summary"], "tail": [type(c).to_dict(c) for c in state["tail"]]}
+    value = _compressor.compress(msgpack.packb(data, use_bin_type=True))
+    try:
+        await redis_client.setex(f"chat:{user_id}", CHAT_TTL_SECONDS, value)
+    except RedisError as e:
+        # El usuario ya recibió la respuesta; solo se pierde este turno del historial.
+        logger.warning("No se pudo guardar el estado de %s en Redis: %s", user_id, e)
+
+def _build_history(state: dict) -> list:
+    """
+    Construye el historial que se pasa a `start_chat`: el resumen (si existe) seguido de los últimos mensajes.
+    """
+    if not state["summary"]:
+        return list(state["tail"])
+    return [
+        genai.protos.Content(role="user", parts=[{"text": f"Resumen de nuestra conversación anterior: {state['summary']}"}]),
+        genai.protos.Content(role="model", parts=[{"text": "Entendido, lo tendré en cuenta."}]),
+        *state["tail"],
+    ]
+
+async def _compress_state(user_id: int, state: dict) -> None:
+    """
+    Condensa en el resumen los mensajes que exceden HISTORY_TAIL.
+    Si Gemini falla, el estado se deja intacto y se reintentará en el siguiente turno.
+    """
+    older = state["tail"][:-HISTORY_TAIL]
+    transcript = "\n".join(
+        f"{c.role}: {' '.join(part.text for part in c.parts)}" for c in older
+    )
+    try:
+        response = await llm_model.generate_content_async(
+            SUMMARY_PROMPT.format(summary=state["summary"] or "(ninguno)", transcript=transcript)
+        )
+        summary = response.text.strip()
+    except Exception as e:
+        logger.warning("No se pudo resumir el historial de %s: %s", user_id, e)
+        return
+
+    state["summary"] = summary
+    state["tail"] = state["tail"][-HISTORY_TAIL:]
+
+# --- Cola de envíos a Telegram ---
+# `_send` es el único limitador de envíos del bot: todos los mensajes y ediciones salientes
+# pasan por él y esperan a tener cupo en dos cubetas: una global (OVERALL_MAX_RATE envíos
+# cada OVERALL_TIME_PERIOD segundos) y, en grupos, una por chat (GROUP_MAX_RATE envíos cada
+# GROUP_TIME_PERIOD segundos). Cada envío ocupa un hueco del semáforo que se libera al
+# terminar el periodo, así los envíos se reparten al ritmo permitido en lugar de acumular
+# errores 429 (útil si se añaden difusiones masivas).
+# La espera por la cubeta de grupo se limita a GROUP_MAX_WAIT segundos: pasado ese tiempo el
+# mensaje se envía igualmente, para que el webhook responda antes del límite de Vercel
+# (si no, Telegram reenviaría la actualización y el usuario recibiría respuestas duplicadas).
+OVERALL_MAX_RATE = 30
+OVERALL_TIME_PERIOD = 1
+GROUP_MAX_RATE = 20
+GROUP_TIME_PERIOD = 60
+GROUP_MAX_WAIT = 5
+_overall_bucket = asyncio.Semaphore(OVERALL_MAX_RATE)
+# chat_id -> [semáforo, huecos ocupados o esperando]; la entrada se borra cuando llega a cero.
+_group_buckets = {}
+
+async def _take(bucket: asyncio.Semaphore, period: float) -> None:
+    await bucket.acquire()
+    asyncio.get_running_loop().call_later(period, bucket.release)
+
+async def _take_group(chat_id: int) -> None:
+    entry = _group_buckets.get(chat_id)
+    if entry is None:
+        entry = _group_buckets[chat_id] = [asyncio.Semaphore(GROUP_MAX_RATE), 0]
+    entry[1] += 1
+
+    def release(acquired: bool) -> None:
+        if acquired:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0 and _group_buckets.get(chat_id) is entry:
+            del _group_buckets[chat_id]
+
+    try:
+        await asyncio.wait_for(entry[0].acquire(), GROUP_MAX_WAIT)
+    except asyncio.TimeoutError:
+        logger.warning("Cupo del grupo %s agotado; se envía sin esperar más.", chat_id)
+        release(False)
+        return
+    asyncio.get_running_loop().call_later(GROUP_TIME_PERIOD, release, True)
+
+async def _send(chat_id: int, send_fn):
+    """
+    Ejecuta `send_fn()` (una llamada a la API de Telegram) respetando los límites de envío.
+    """
+    # En Telegram los chats de grupo tienen identificador negativo.
+    if chat_id < 0:
+        await _take_group(chat_id)
+    await _take(_overall_bucket, OVERALL_TIME_PERIOD)
+    return await send_fn()
+
+# --- Envío de respuestas en streaming ---
+# La respuesta de Gemini se muestra a medida que se genera editando el mismo mensaje,
+# como mucho una vez cada STREAM_EDIT_INTERVAL segundos (Telegram limita a ~1 mensaje/s por chat).
+# En grupos no se hacen ediciones intermedias: cada una gastaría cupo del límite por grupo,
+# así que solo se envía el texto de cada mensaje una vez completo.
+# Si el texto supera TELEGRAM_MAX_LENGTH caracteres, continúa en un mensaje nuevo.
+TELEGRAM_MAX_LENGTH = 4096
+STREAM_EDIT_INTERVAL = 1.1
+
+def _chunk_text(chunk) -> str:
+    # `chunk.text` lanza ValueError si el fragmento no trae texto (p. ej. si fue bloqueado).
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+async def _stream_reply(message, response) -> str:
+    """
+    Envía al usuario la respuesta en streaming de Gemini y devuelve el texto completo.
+    No envía nada si la respuesta llega vacía.
+    """
+    text = ""
+    offset = 0      # posición en `text` donde empieza el mensaje que se está editando
+    sent = None     # mensaje de Telegram que se está editando
+    shown = ""      # texto que muestra actualmente `sent`
+    last_edit = 0.0
+    stream_edits = message.chat_id > 0
+
+    async def show(part: str) -> None:
+        nonlocal sent, shown, last_edit
+        # Telegram recorta los espacios del texto: un cambio solo de espacios no es una edición
+        # ("message is not modified") y un texto solo de espacios no se puede enviar.
+        if not part.strip() or part.strip() == shown.strip():
+            return
+        # Todos los envíos (ediciones, mensajes de continuación y el último) respetan el intervalo.
+        wait = STREAM_EDIT_INTERVAL - (time.monotonic() - last_edit)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if sent is None:
+            sent = await _send(message.chat_id, lambda: message.reply_text(part))
+        else:
+            try:
+                await _send(message.chat_id, lambda: sent.edit_text(part))
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+        shown = part
+        last_edit = time.monotonic()
+
+    async for chunk in response:
+        text += _chunk_text(chunk)
+        while len(text) - offset > TELEGRAM_MAX_LENGTH:
+            await show(text[offset:offset + TELEGRAM_MAX_LENGTH])
+            offset += TELEGRAM_MAX_LENGTH
+            sent, shown = None, ""
+        if stream_edits and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and text[offset:]:
+            await show(text[offset:])
+
+    if text[offset:]:
+        await show(text[offset:])
+    return text
+
+# Saludo estático de /start: no necesita ninguna llamada a Gemini.
+GREETING_TEMPLATE = "¡Hola {name}! Soy tu asistente de IA. Envíame un mensaje y conversaremos."
+
+# Mensajes para el usuario cuando Gemini no devuelve texto, según la razón de finalización.
+REASON_REPLIES: dict[str, str] = {
+    "RECITATION": "Lo siento, no puedo proporcionar esa información directamente debido a restricciones de contenido (posible recitación de fuentes). Por favor, intenta reformular tu pregunta.",
+    "SAFETY": "Lo siento, no puedo responder a esa pregunta debido a nuestras políticas de seguridad de contenido. Por favor, intenta con otra pregunta.",
+}
+
+# Razones de finalización con las que la respuesta se considera completa y se añade al historial.
+# Con cualquier otra, `ChatSession.history` lanza BrokenResponseError.
+COMPLETE_FINISH_REASONS = {None, "STOP", "MAX_TOKENS"}
+
+def _finish_reason(candidate) -> str | None:
+    reason = getattr(candidate, 'finish_reason', None)
+    return reason.name if reason else None
+
+# --- Peticiones grandes a Gemini ---
+# Con historiales grandes, serializar la petición (protobuf) ocupa CPU en el bucle de eventos y
+# retrasa al resto de chats. A partir de OFFLOAD_MIN_CHARS caracteres la llamada se hace con la
+# API síncrona en un hilo del executor por defecto (dimensionado según las CPUs en `_get_app`),
+# también en streaming: el hilo pasa los fragmentos al bucle a medida que llegan.
+OFFLOAD_MIN_CHARS = 8000
+OFFLOAD_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def _payload_chars(history: list, user_message: str) -> int:
+    return len(user_message) + sum(len(part.text) for content in history for part in content.parts)
+
+_STREAM_END = object()
+
+async def _threaded_stream(response):
+    """
+    Recorre en un hilo una respuesta síncrona en streaming y entrega sus fragmentos al bucle de eventos.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    def pump() -> None:
+        try:
+            for chunk in response:
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, _STREAM_END)
+
+    pumping = loop.run_in_executor(None, pump)
+    while (chunk := await chunks.get()) is not _STREAM_END:
+        yield chunk
+    # Propaga los errores que haya lanzado el hilo.
+    await pumping
 
 # --- Funciones Manejadoras de Telegram (async) ---
 # Estas son las mismas funciones 'start' y 'handle_message' que ya tienes.
 # Asegúrate de copiarlas aquí con sus decoradores `async def`.
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /start no toca el estado de la conversación: este se crea con el primer mensaje real.
     user_id = update.effective_user.id
-    if user_id not in user_chats:
-        user_chats[user_id] = llm_model.start_chat(history=[])
-
-    await update.message.reply_text(f"¡Hola {update.effective_user.first_name}! Soy tu asistente de IA. Envíame un mensaje y conversaremos.")
-    logger.info(f"Comando /start recibido de {user_id}")
+    greeting = GREETING_TEMPLATE.format(name=update.effective_user.first_name)
+    await _send(update.effective_chat.id, lambda: update.message.reply_text(greeting))
+    logger.info("Comando /start recibido de %s", user_id)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_message = update.message.text
     user_id = update.effective_user.id
 
-    if user_id not in user_chats:
-        user_chats[user_id] = llm_model.start_chat(history=[])
+    async with _user_lock(user_id):
+        try:
+            state = await _load_state(user_id)
+            history = _build_history(state)
+            chat_session = llm_model.start_chat(history=history)
+            if _payload_chars(history, user_message) >= OFFLOAD_MIN_CHARS:
+                response = await asyncio.to_thread(chat_session.send_message, user_message, stream=True)
+                text = await _stream_reply(update.message, _threaded_stream(response))
+            else:
+                response = await chat_session.send_message_async(user_message, stream=True)
+                text = await _stream_reply(update.message, response)
+            candidate = response.candidates[0] if response.candidates else None
+            finish_reason = _finish_reason(candidate)
+            completed = candidate is not None and finish_reason in COMPLETE_FINISH_REASONS
 
-    chat_session = user_chats[user_id]
+            # El historial solo se amplía con respuestas completas.
+            if completed:
+                state["tail"] = state["tail"] + chat_session.history[len(history):]
 
-    try:
-        response = await chat_session.send_message_async(user_message)
-
-        if response.text:
-            await update.message.reply_text(response.text)
-            logger.info(f"Respuesta enviada a {user_id}: {response.text[:50]}...")
-        else:
-            finish_reason = None
-            if response.candidates:
-                first_candidate = response.candidates[0]
-                if hasattr(first_candidate, 'finish_reason'):
-                    finish_reason = first_candidate.finish_reason.name
-                elif hasattr(first_candidate, 'safety_ratings') and first_candidate.safety_ratings:
-                    for rating in first_candidate.safety_ratings:
-                        if rating.blocked:
-                            finish_reason = f"SEGURIDAD: {rating.category.name}"
-                            break
-
-            if finish_reason:
-                if "RECITATION" in finish_reason:
-                    await update.message.reply_text("Lo siento, no puedo proporcionar esa información directamente debido a restricciones de contenido (posible recitación de fuentes). Por favor, intenta reformular tu pregunta.")
-                elif "SAFETY" in finish_reason:
-                     await update.message.reply_text("Lo siento, no puedo responder a esa pregunta debido a nuestras políticas de seguridad de contenido. Por favor, intenta con otra pregunta.")
-                else:
-                    await update.message.reply_text(f"Lo siento, no pude generar una respuesta clara. Razón: {finish_reason}. ¿Puedes intentar reformular?")
+            if text and completed:
+                logger.info("Respuesta enviada a %s: %.50s...", user_id, text)
             else:
-                await update.message.reply_text("Lo siento, no pude generar una respuesta para esa pregunta. Por favor, intenta reformularla.")
-            logger.warning(f"Respuesta vacía o filtrada para {user_id}. Razón: {finish_reason or 'Desconocida'}")
+                if finish_reason:
+                    reply = REASON_REPLIES.get(finish_reason) or f"Lo siento, no pude generar una respuesta clara. Razón: {finish_reason}. ¿Puedes intentar reformular?"
+                else:
+                    reply = "Lo siento, no pude generar una respuesta para esa pregunta. Por favor, intenta reformularla."
+                await _send(update.effective_chat.id, lambda: update.message.reply_text(reply))
+                logger.warning("Respuesta vacía o filtrada para %s. Razón: %s", user_id, finish_reason or 'Desconocida')
+
+            # El usuario ya tiene su respuesta; ahora se actualiza (y si toca, se resume) el estado.
+            if len(state["tail"]) >= HISTORY_TAIL + 2 * SUMMARY_EVERY_TURNS:
+                await _compress_state(user_id, state)
+            await _save_state(user_id, state)
+
+        except Exception as e:
+            logger.error("Ocurrió un error al procesar el mensaje para el usuario %s: %s", user_id, e)
+            await _send(
+                update.effective_chat.id,
+                lambda: update.message.reply_text("Lo siento, hubo un error al procesar tu solicitud. Por favor, inténtalo de nuevo más tarde."),
+            )
+
 
+# --- Handlers ---
+# Se construyen una sola vez al importar el módulo y se registran en la Application compartida.
+TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+START_HANDLER = CommandHandler("start", start)
+MSG_HANDLER = MessageHandler(TEXT_FILTER, handle_message)
+
+
+# --- Instancia única de Application ---
+# La Application se construye una sola vez por contenedor. Vercel reutiliza los
+# contenedores "calientes" entre invocaciones, así que el cliente HTTP, los handlers
+# y la inicialización del bot se aprovechan en las siguientes peticiones.
+# Los recursos asíncronos (pool HTTP, conexiones a Redis, locks, cubetas de envío) quedan ligados al bucle de
+# eventos en el que se crearon, así que se guarda ese bucle en `_app_loop` y solo se
+# reconstruyen si el runtime invoca el handler desde un bucle distinto.
+_app: Application | None = None
+_app_loop: asyncio.AbstractEventLoop | None = None
+_app_lock = asyncio.Lock()
+
+async def _close_previous(application: Application | None, client: Redis | None) -> None:
+    """
+    Libera los recursos del bucle anterior. Si ese bucle ya está cerrado puede fallar;
+    en ese caso solo se registra, porque sus conexiones no se pueden reutilizar igualmente.
+    """
+    try:
+        if application is not None:
+            await application.shutdown()
+        if client is not None:
+            await client.aclose()
     except Exception as e:
-        logger.error(f"Ocurrió un error al procesar el mensaje para el usuario {user_id}: {e}")
-        await update.message.reply_text("Lo siento, hubo un error al procesar tu solicitud. Por favor, inténtalo de nuevo más tarde.")
+        logger.warning("No se pudieron cerrar los recursos del bucle anterior: %s", e)
+
+async def _get_app() -> Application:
+    """
+    Devuelve la Application compartida, construyéndola e inicializándola la primera vez
+    (o cuando cambia el bucle de eventos).
+    """
+    global _app, _app_loop, _app_lock, _overall_bucket, redis_client
+    loop = asyncio.get_running_loop()
+    if loop is not _app_loop:
+        # Todo el cambio de bucle se hace sin `await`, para que las peticiones concurrentes
+        # vean ya el bucle nuevo; los recursos anteriores se cierran después.
+        previous_app, previous_redis = _app, redis_client
+        if _app_loop is not None:
+            logger.info("Nuevo bucle de eventos detectado; se reconstruye la Application.")
+        _app, _app_loop = None, loop
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=OFFLOAD_MAX_WORKERS))
+        _app_lock = asyncio.Lock()
+        _user_locks.clear()
+        _overall_bucket = asyncio.Semaphore(OVERALL_MAX_RATE)
+        _group_buckets.clear()
+        redis_client = Redis.from_url(
+            REDIS_URL,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT,
+        ) if REDIS_URL else None
+        await _close_previous(previous_app, previous_redis)
+
+    if _app is not None:
+        return _app
+
+    async with _app_lock:
+        if _app is None:
+            # Un único pool de conexiones HTTP/2 con keep-alive para todas las llamadas a Telegram.
+            request = HTTPXRequest(connection_pool_size=50, http_version="2")
+            application = (
+                Application.builder()
+                .token(TELEGRAM_BOT_TOKEN)
+                .request(request)
+                .build()
+            )
+            application.add_handler(START_HANDLER)
+            application.add_handler(MSG_HANDLER)
+            await application.initialize()
+            _app = application
+    return _app
 
 
 # --- Función Principal que Vercel invocará ---
@@ -104,7 +507,7 @@ async def handler(request):
     """
     Función principal que Vercel invoca para manejar las solicitudes HTTP (webhooks).
     """
-    logger.info(f"Petición recibida: {request.method} {request.url}")
+    logger.info("Petición recibida: %s %s", request.method, request.url)
 
 
     # Asegúrate de que el token esté disponible antes de construir la aplicación PTB
@@ -112,20 +515,13 @@ async def handler(request):
         logger.error("TELEGRAM_BOT_TOKEN no configurado en el handler de Vercel.")
         return {"body": "Internal Server Error: Bot Token not configured", "statusCode": 500}
 
-    # Cada vez que llega un webhook, creamos una nueva instancia de Application.
-    # Esto es normal en serverless.
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Registra tus handlers dentro de la función de manejo de la petición.
-    # Esto asegura que cada invocación de la función serverless tenga sus handlers listos.
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-
     if request.method == 'POST':
         try:
-            # Lee el cuerpo de la petición como JSON (esto viene de Telegram)
-            update_data = await request.json()
-            
+            application = await _get_app()
+
+            # Lee el cuerpo de la petición y lo parsea como JSON con orjson (esto viene de Telegram)
+            update_data = orjson.loads(await request.body())
+
             # Crea un objeto Update a partir del JSON recibido
             update = Update.de_json(update_data, application.bot)
 
@@ -136,7 +532,7 @@ async def handler(request):
             # Telegram espera un 200 OK para confirmar que se recibió el webhook.
             return {"body": "OK", "statusCode": 200}
         except Exception as e:
-            logger.error(f"Error procesando webhook: {e}")
+            logger.error("Error procesando webhook: %s", e)
             # Devuelve un error para que Telegram sepa que algo falló, aunque a veces un 200 es mejor.
             # Para depurar, dejar el mensaje de error es útil.
             return {"body": f"Error: {e}", "statusCode": 500}
@@ -148,5 +544,5 @@ async def handler(request):
     
     # **Notas Importantes sobre `api/webhook.py`:**
     # **Variables de Entorno:** `load_dotenv()` está ahí por si pruebas localmente. En Vercel, las variables (`GOOGLE_API_KEY`, `TELEGRAM_BOT_TOKEN`) se inyectarán directamente en el entorno de ejecución de la función.
-    # **`user_chats`:** Reitero la advertencia. Para mantener el historial de conversación, necesitarás una base de datos externa. Por ahora, cada mensaje será como el inicio de una nueva conversación para el LLM.
+    # **Historial (`REDIS_URL`):** El historial de conversación se guarda en Redis para que sobreviva a los arranques en frío. Sin `REDIS_URL` solo se conserva en memoria mientras el contenedor siga vivo.
     # **`async def handler(request)`:** Esta es la función principal que Vercel buscará y ejecutará cuando reciba una solicitud HTTP en la ruta configurada.
\ No newline at end of file